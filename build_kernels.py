@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Ahead-of-time compile the gallery kernels into the face_kernels extension
+Removes the Numba JIT warm-up from single-shot authentication runs
+
+Run once after installing dependencies:
+    python build_kernels.py
+"""
+
+from numba.pycc import CC
+
+from face_numba import l2_scan, score_users
+
+cc = CC('face_kernels')
+cc.verbose = True
+
+# stats[U, 2] = score_users(encodings[N, 128], offsets[U + 1], query[128])
+cc.export('score_users', 'f4[:,:](f4[:,:], i4[:], f4[:])')(score_users)
+
+# l2_scan(encodings[N, 128], query[128], out[N])
+cc.export('l2_scan', 'void(f4[:,:], f4[:], f4[:])')(l2_scan)
+
+if __name__ == "__main__":
+    cc.compile()
@@ -0,0 +1,669 @@
+"""
+Shared helpers for the Python face authentication scripts
+Encoding storage and loading used by both implementations
+"""
+
+import json
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODING_DIM = 128
+
+# Packed .bin layout: header (magic, num_samples, dim, dtype code), then the payload.
+# int8 payloads carry one float32 scale per sample ahead of the quantized values.
+PACKED_MAGIC = b"FENC"
+PACKED_HEADER = struct.Struct("<4sIIB3x")
+PACKED_DTYPES = {"float16": 1, "int8": 2}
+
+# Authentication log appended next to the database: per record, epoch milliseconds and the
+# UTF-8 user_id length, followed by the user_id bytes
+AUTH_LOG_RECORD = struct.Struct("<QH")
+
+# Sidecar formats accepted by --encoding-format, mapped to their file extension
+ENCODING_FORMATS = {"npy": ".npy", "float16": ".bin", "int8": ".bin"}
+
+# Capture resolution requested by open_camera
+CAMERA_WIDTH = 640
+CAMERA_HEIGHT = 480
+
+# User files authentication reads from source/, the consolidated cache built from them,
+# and the FAISS index over that cache's rows
+SOURCE_FILE_EXTENSIONS = (".json", ".npy", ".bin")
+SOURCE_CACHE_NAME = "_all.npz"
+SOURCE_INDEX_NAME = "_index.faiss"
+
+# Below this many user files, worker process startup costs more than parsing serially
+PARALLEL_LOAD_MIN_FILES = 16
+
+# Galleries up to this size are scanned with the compiled l2_scan kernel instead of BLAS
+SCAN_KERNEL_MAX_SAMPLES = 1024
+
+# Galleries at least this large use a FAISS index for nearest-sample search when faiss is installed.
+# The index stores 8-bit codes; its top candidates are re-scored against the float32 rows.
+FAISS_MIN_SAMPLES = 4096
+RERANK_CANDIDATES = 10
+
+# Above this many samples the index switches to IVF-PQ: sqrt(N) k-means cells with 16 x 8-bit
+# product-quantized codes, probing IVF_NPROBE cells per query instead of scanning every row
+IVF_MIN_SAMPLES = 10000
+IVF_PQ_SUBQUANTIZERS = 16
+IVF_PQ_BITS = 8
+IVF_NPROBE = 8
+
+# Match tolerance per distance metric; cosine distance is 1 - cos(a, b)
+DEFAULT_TOLERANCES = {"euclidean": 0.6, "cosine": 0.18}
+
+
+def auth_log_path(db_path: str) -> str:
+    """Path of the authentication log kept beside a database JSON"""
+    return os.path.splitext(db_path)[0] + "_auth_log.bin"
+
+
+def record_authentication(database: dict, user_id: str, when: datetime):
+    """Bump a user's authentication stats in the in-memory database"""
+    user_data = database["users"][user_id]
+    user_data["last_authentication"] = when.isoformat()
+    user_data["authentication_count"] = user_data.get("authentication_count", 0) + 1
+
+
+def append_auth_log(log_path: str, user_id: str, when: datetime):
+    """Append one authentication record instead of rewriting the whole database"""
+    name = user_id.encode("utf-8")
+    with open(log_path, 'ab') as f:
+        f.write(AUTH_LOG_RECORD.pack(int(when.timestamp() * 1000), len(name)) + name)
+
+
+def replay_auth_log(log_path: str, database: dict) -> int:
+    """
+    Apply authentications logged since the database was last saved; returns how many were applied
+    A partial final record from an interrupted write is ignored
+    """
+    if not os.path.exists(log_path):
+        return 0
+
+    with open(log_path, 'rb') as f:
+        data = f.read()
+
+    users = database.get("users", {})
+    applied = 0
+    offset = 0
+    while offset + AUTH_LOG_RECORD.size <= len(data):
+        epoch_ms, name_length = AUTH_LOG_RECORD.unpack_from(data, offset)
+        offset += AUTH_LOG_RECORD.size
+        if offset + name_length > len(data):
+            break
+
+        user_id = data[offset:offset + name_length].decode("utf-8", errors="replace")
+        offset += name_length
+        if user_id in users:
+            record_authentication(database, user_id, datetime.fromtimestamp(epoch_ms / 1000))
+            applied += 1
+    return applied
+
+
+def _json_default(obj):
+    """Serialize NumPy values neither JSON backend handles natively (e.g. memmap and other ndarray subclasses)"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def write_json(path: str, data, indent: bool = False):
+    """
+    Write data as JSON, through orjson when installed; compact unless indent is set
+    NumPy arrays are serialized directly, so encodings need no .tolist() first
+    """
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, default=_json_default, option=option))
+        return
+
+    with open(path, 'w') as f:
+        if indent:
+            json.dump(data, f, indent=2, default=_json_default)
+        else:
+            json.dump(data, f, separators=(',', ':'), default=_json_default)
+
+
+def save_encoding_matrix(path: str, encodings: List) -> np.ndarray:
+    """Persist encodings as one contiguous float32 [num_samples, 128] .npy file"""
+    matrix = np.ascontiguousarray(np.stack([np.asarray(e) for e in encodings]).astype(np.float32))
+    np.save(path, matrix)
+    return matrix
+
+
+def load_encoding_matrix(path: str) -> np.ndarray:
+    """Memory-map a float32 encoding matrix saved by save_encoding_matrix"""
+    return np.load(path, mmap_mode='r')
+
+
+def _encode_to_fp16(encodings: np.ndarray) -> bytes:
+    """Pack encodings as raw float16 bytes"""
+    return np.ascontiguousarray(encodings, dtype=np.float16).tobytes()
+
+
+def _encode_to_int8(encodings: np.ndarray) -> bytes:
+    """Quantize each encoding to int8 with its own max-abs scale"""
+    scales = np.abs(encodings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(encodings / scales[:, None]).astype(np.int8)
+    return scales.astype(np.float32).tobytes() + quantized.tobytes()
+
+
+def save_packed_encodings(path: str, encodings: List, dtype: str = "float16") -> np.ndarray:
+    """
+    Persist encodings as a packed float16 or int8 binary file
+    Returns the float32 matrix as it will read back, quantization included
+    """
+    matrix = np.stack([np.asarray(e) for e in encodings]).astype(np.float32)
+    payload = _encode_to_fp16(matrix) if dtype == "float16" else _encode_to_int8(matrix)
+
+    with open(path, 'wb') as f:
+        f.write(PACKED_HEADER.pack(PACKED_MAGIC, matrix.shape[0], matrix.shape[1], PACKED_DTYPES[dtype]))
+        f.write(payload)
+
+    return load_packed_encodings(path)
+
+
+def load_packed_encodings(path: str) -> np.ndarray:
+    """Map a packed .bin file and widen it to a float32 [num_samples, dim] matrix"""
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    magic, num_samples, dim, dtype_code = PACKED_HEADER.unpack(data[:PACKED_HEADER.size].tobytes())
+    if magic != PACKED_MAGIC:
+        raise ValueError(f"{path} is not a packed encoding file")
+
+    offset = PACKED_HEADER.size
+    count = num_samples * dim
+    if dtype_code == PACKED_DTYPES["float16"]:
+        values = np.frombuffer(data, dtype=np.float16, count=count, offset=offset)
+        return values.reshape(num_samples, dim).astype(np.float32)
+
+    if dtype_code == PACKED_DTYPES["int8"]:
+        scales = np.frombuffer(data, dtype=np.float32, count=num_samples, offset=offset)
+        values = np.frombuffer(data, dtype=np.int8, count=count, offset=offset + scales.nbytes)
+        return values.reshape(num_samples, dim).astype(np.float32) * scales[:, None]
+
+    raise ValueError(f"Unknown encoding dtype code {dtype_code} in {path}")
+
+
+def save_encoding_sidecar(base_path: str, encodings: List, encoding_format: str = "npy") -> np.ndarray:
+    """
+    Write a user's encodings next to base_path in the requested format
+    Removes sidecars left over from other formats so loading stays unambiguous
+    """
+    for extension in set(ENCODING_FORMATS.values()):
+        stale_path = base_path + extension
+        if extension != ENCODING_FORMATS[encoding_format] and os.path.exists(stale_path):
+            os.remove(stale_path)
+
+    if encoding_format == "npy":
+        return save_encoding_matrix(base_path + ".npy", encodings)
+    return save_packed_encodings(base_path + ".bin", encodings, encoding_format)
+
+
+def load_user_file(json_path: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    """
+    Load (user_id, encodings) for a user file
+    The JSON is only metadata when it carries an "encodings_file" pointer, so parsing it stays cheap
+    """
+    with open(json_path, 'r') as f:
+        user_data = json.load(f)
+
+    return user_data.get("user_id"), user_entry_encodings(user_data, os.path.dirname(json_path))
+
+
+def load_encodings_file(path: str) -> np.ndarray:
+    """Load a .npy or packed .bin encodings file"""
+    if path.endswith(".npy"):
+        return load_encoding_matrix(path)
+    return load_packed_encodings(path)
+
+
+def user_entry_encodings(user_data: dict, base_dir: str) -> Optional[np.ndarray]:
+    """
+    Encodings of a user record: follows its "encodings_file" pointer (relative to base_dir)
+    or reads the embedded face_encodings; None when it has neither
+    Raises ValueError unless they form a [num_samples, ENCODING_DIM] matrix, so one bad record
+    is reported and skipped instead of breaking the gallery stack
+    """
+    # Metadata-only records point at their encodings instead of embedding them
+    encodings_file = user_data.get("encodings_file")
+    if encodings_file:
+        encodings = load_encodings_file(os.path.join(base_dir, encodings_file))
+    else:
+        samples = user_data.get("face_encodings", [])
+        if not samples:
+            return None
+        encodings = np.array([sample["encoding"] for sample in samples], dtype=np.float32)
+
+    if encodings.ndim != 2 or encodings.shape[1] != ENCODING_DIM:
+        raise ValueError(f"expected {ENCODING_DIM}-d encodings, got shape {encodings.shape}")
+    return encodings
+
+
+def _load_user_file_safe(json_path: str) -> Tuple[Optional[str], Optional[np.ndarray], Optional[str]]:
+    """load_user_file for pool workers: returns (user_id, encodings, error) instead of raising"""
+    try:
+        user_id, encodings = load_user_file(json_path)
+        return user_id, None if encodings is None else np.asarray(encodings), None
+    except Exception as e:
+        return None, None, str(e)
+
+
+def load_user_files(paths: List[str], max_workers: Optional[int] = None) -> List[Tuple]:
+    """
+    Load (user_id, encodings, error) for every user file, in the order given
+    Large directories are parsed across a process pool
+    """
+    if max_workers == 1 or len(paths) < PARALLEL_LOAD_MIN_FILES:
+        return [_load_user_file_safe(path) for path in paths]
+
+    workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_load_user_file_safe, paths, chunksize=max(1, len(paths) // (workers * 4))))
+
+
+def preview_available() -> bool:
+    """
+    Whether capture preview windows can be shown
+    macOS and Windows always have a window server; elsewhere DISPLAY or WAYLAND_DISPLAY must be set.
+    FACE_AUTH_HEADLESS turns previews off everywhere.
+    """
+    if os.environ.get("FACE_AUTH_HEADLESS"):
+        return False
+    if sys.platform in ("darwin", "win32"):
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+def open_camera(index: int = 0):
+    """
+    Open a camera as MJPG at CAMERA_WIDTH x CAMERA_HEIGHT with a one-frame driver buffer
+    MJPG frames decode cheaper than raw YUYV at the default (often 720p) size, and the
+    small buffer keeps reads from returning stale frames; drivers may ignore any setting
+    """
+    import cv2
+
+    cap = cv2.VideoCapture(index)
+    if cap.isOpened():
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+
+def copy_to_buffer(buffer: Optional[np.ndarray], frame: np.ndarray) -> np.ndarray:
+    """Copy a frame into a reusable display buffer, allocating only when the frame shape changes"""
+    if buffer is None or buffer.shape != frame.shape or buffer.dtype != frame.dtype:
+        buffer = np.empty_like(frame)
+    np.copyto(buffer, frame)
+    return buffer
+
+
+def downscale_image(image: np.ndarray, scale: float) -> np.ndarray:
+    """Shrink an image for face detection; detection cost scales with pixel count"""
+    import cv2
+
+    if scale >= 1.0:
+        return image
+    return cv2.resize(image, (0, 0), fx=scale, fy=scale)
+
+
+def upscale_face_locations(locations: List[Tuple], scale: float, image_shape: Tuple) -> List[Tuple]:
+    """Map (top, right, bottom, left) boxes found on a downscaled image back to full resolution"""
+    if scale >= 1.0:
+        return list(locations)
+
+    height, width = image_shape[:2]
+    return [(max(0, int(round(top / scale))), min(width, int(round(right / scale))),
+             min(height, int(round(bottom / scale))), max(0, int(round(left / scale))))
+            for top, right, bottom, left in locations]
+
+
+def detect_face_locations(image: np.ndarray, model: str = "hog", scale: float = 0.25) -> List[Tuple]:
+    """Detect faces on a downscaled copy and return boxes in full-resolution coordinates"""
+    import face_recognition
+
+    small = downscale_image(image, scale)
+    locations = face_recognition.face_locations(small, model=model)
+    return upscale_face_locations(locations, scale, image.shape)
+
+
+def batch_detect_face_locations(images: List[np.ndarray], scale: float = 0.25) -> Optional[List[List[Tuple]]]:
+    """
+    CNN-detect faces in all images with one batched GPU call, in full-resolution coordinates
+    Returns None when dlib lacks CUDA or the images differ in size, which batching requires
+    """
+    import dlib
+    import face_recognition
+
+    if not images or not dlib.DLIB_USE_CUDA or len({image.shape for image in images}) != 1:
+        return None
+
+    small_images = [downscale_image(image, scale) for image in images]
+    batch_locations = face_recognition.batch_face_locations(small_images, number_of_times_to_upsample=1,
+                                                            batch_size=len(small_images))
+    return [upscale_face_locations(locations, scale, image.shape)
+            for image, locations in zip(images, batch_locations)]
+
+
+@lru_cache(maxsize=None)
+def load_face_models() -> Tuple:
+    """
+    (5-point landmark predictor, face encoder) dlib objects, resolved once per process
+    Calling them directly skips face_recognition's per-call wrapper work
+    """
+    from face_recognition import api
+    return api.pose_predictor_5_point, api.face_encoder
+
+
+def encode_face(image: np.ndarray, location: Tuple, num_jitters: int = 1) -> np.ndarray:
+    """Encode the face at a (top, right, bottom, left) location with one direct dlib call"""
+    import dlib
+
+    predictor, encoder = load_face_models()
+    top, right, bottom, left = location
+    landmarks = predictor(image, dlib.rectangle(left, top, right, bottom))
+    return np.array(encoder.compute_face_descriptor(image, landmarks, num_jitters))
+
+
+def batch_face_encodings(images: List[np.ndarray], locations: List[Tuple], num_jitters: int = 1) -> List[np.ndarray]:
+    """
+    Encode one face per image with a single dlib compute_face_descriptor call
+    Falls back to per-image encoding when the installed dlib lacks the batch overload
+    """
+    import dlib
+
+    if not images:
+        return []
+
+    predictor, encoder = load_face_models()
+    try:
+        # Same 5-point landmarks face_recognition.face_encodings uses by default
+        batch_landmarks = []
+        for image, (top, right, bottom, left) in zip(images, locations):
+            landmarks = dlib.full_object_detections()
+            landmarks.append(predictor(image, dlib.rectangle(left, top, right, bottom)))
+            batch_landmarks.append(landmarks)
+
+        descriptors = encoder.compute_face_descriptor(images, batch_landmarks, num_jitters)
+        return [np.array(descriptor[0]) for descriptor in descriptors]
+    except (TypeError, RuntimeError):
+        return [encode_face(image, location, num_jitters) for image, location in zip(images, locations)]
+
+
+@lru_cache(maxsize=None)
+def load_score_kernel():
+    """
+    Return score_users from the AOT face_kernels extension built by build_kernels.py, or None
+    Numba's JIT is deliberately not used: importing numba and compiling cost more than a
+    single-shot CLI run saves, and frozen builds cannot keep the JIT cache
+    """
+    try:
+        from face_kernels import score_users
+    except ImportError:
+        return None
+    return score_users
+
+
+@lru_cache(maxsize=None)
+def load_scan_kernel():
+    """Return l2_scan from the AOT face_kernels extension, or None (no JIT fallback, see load_score_kernel)"""
+    try:
+        from face_kernels import l2_scan
+    except ImportError:
+        return None
+    return l2_scan
+
+
+@lru_cache(maxsize=None)
+def load_argmin_kernel():
+    """Return argmin_l2 from the Cython fast_match extension, or None when it is not built"""
+    try:
+        from fast_match import argmin_l2
+    except ImportError:
+        return None
+    return argmin_l2
+
+
+class FaceGallery:
+    """All enrolled encodings stacked into one float32 [N, 128] matrix with per-user row ranges"""
+
+    def __init__(self, user_ids: List[str], matrices: List[np.ndarray]):
+        # Users without samples would produce empty reduceat segments
+        enrolled = [(user_id, m) for user_id, m in zip(user_ids, matrices) if len(m) > 0]
+        self.user_ids = [user_id for user_id, _ in enrolled]
+        self.sources = None
+        matrices = [m for _, m in enrolled]
+
+        counts = np.array([len(m) for m in matrices], dtype=np.int32)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int32)
+        np.cumsum(counts, out=offsets[1:])
+
+        if matrices:
+            encodings = np.concatenate(matrices).astype(np.float32, copy=False)
+        else:
+            encodings = np.empty((0, ENCODING_DIM), dtype=np.float32)
+
+        self._set_arrays(encodings, offsets)
+
+    @classmethod
+    def from_arrays(cls, user_ids: List[str], encodings: np.ndarray, offsets: np.ndarray) -> "FaceGallery":
+        """Wrap an already stacked matrix and its per-user offsets"""
+        gallery = cls.__new__(cls)
+        gallery.user_ids = list(user_ids)
+        gallery.sources = None
+        gallery._set_arrays(encodings, offsets)
+        return gallery
+
+    def _set_arrays(self, encodings: np.ndarray, offsets: np.ndarray):
+        self.encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        self.owners = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int32), np.diff(self.offsets))
+
+        # ||g - q||^2 = ||g||^2 - 2 g.q + ||q||^2, so only g.q depends on the query
+        self.sq_norms = np.einsum('ij,ij->i', self.encodings, self.encodings)
+        self._unit_encodings = None
+        self._index = None
+        self._gpu_resources = None
+
+    def save(self, path: str, sources: Optional[List[str]] = None):
+        """
+        Write the gallery to an .npz file atomically (temp file, then rename)
+        sources optionally records the files it was built from, so callers can detect removals
+        """
+        tmp_path = path + ".tmp"
+        extra = {} if sources is None else {"sources": np.array(sources, dtype=str)}
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, encodings=self.encodings, offsets=self.offsets, owners=self.owners,
+                     user_ids=np.array(self.user_ids, dtype=str), **extra)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "FaceGallery":
+        """Load a gallery written by save(); its sources list is None if none was recorded"""
+        with np.load(path, allow_pickle=False) as data:
+            gallery = cls.from_arrays(data["user_ids"].tolist(), data["encodings"], data["offsets"])
+            gallery.sources = data["sources"].tolist() if "sources" in data.files else None
+            return gallery
+
+    def __len__(self) -> int:
+        return len(self.encodings)
+
+    @property
+    def unit_encodings(self) -> np.ndarray:
+        """Row-L2-normalized gallery, built once on first cosine match"""
+        if self._unit_encodings is None:
+            norms = np.sqrt(self.sq_norms)
+            norms[norms == 0] = 1.0
+            self._unit_encodings = np.ascontiguousarray(self.encodings / norms[:, None])
+        return self._unit_encodings
+
+    def distances(self, query: np.ndarray, metric: str = "euclidean") -> np.ndarray:
+        """Distance from the query to every stored sample with a single matrix-vector product"""
+        q = np.asarray(query, dtype=np.float32)
+
+        if metric == "cosine":
+            q_norm = np.linalg.norm(q)
+            if q_norm > 0:
+                q = q / q_norm
+            return 1.0 - self.unit_encodings @ q
+
+        return np.sqrt(self.sq_distances(q))
+
+    def search_index(self, index_path: Optional[str] = None, valid_after: float = 0.0):
+        """
+        FAISS L2 index over the gallery: 8-bit scalar quantized, or IVF-PQ for very large galleries
+        None when faiss is missing or the gallery is small enough to scan directly
+        A trained index is reused from index_path if it is newer than valid_after and has every row
+        """
+        if self._index is not None or len(self) < FAISS_MIN_SAMPLES:
+            return self._index
+
+        try:
+            import faiss
+        except ImportError:
+            return None
+
+        if index_path and os.path.exists(index_path) and os.path.getmtime(index_path) >= valid_after:
+            index = faiss.read_index(index_path)
+            if index.ntotal == len(self) and index.d == self.encodings.shape[1]:
+                if len(self) >= IVF_MIN_SAMPLES:
+                    faiss.extract_index_ivf(index).nprobe = IVF_NPROBE
+                self._index = self._to_gpu(faiss, index)
+                return self._index
+
+        dim = self.encodings.shape[1]
+        if len(self) >= IVF_MIN_SAMPLES:
+            quantizer = faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, int(np.sqrt(len(self))), IVF_PQ_SUBQUANTIZERS, IVF_PQ_BITS)
+            index.nprobe = IVF_NPROBE
+        else:
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+        index.train(self.encodings)
+        index.add(self.encodings)
+
+        if index_path:
+            # IVF training is the slow part, so keep the trained index for the next run
+            faiss.write_index(index, index_path)
+        self._index = self._to_gpu(faiss, index)
+        return self._index
+
+    def _to_gpu(self, faiss, index):
+        """Move the index to the first GPU when faiss was built with CUDA; otherwise keep it on the CPU"""
+        if not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+            return index
+        try:
+            # The resources object owns the device memory and must outlive the GPU index
+            self._gpu_resources = faiss.StandardGpuResources()
+            return faiss.index_cpu_to_gpu(self._gpu_resources, 0, index)
+        except RuntimeError:
+            # Not every index type has a GPU implementation
+            return index
+
+    def nearest(self, query: np.ndarray, index_path: Optional[str] = None,
+                valid_after: float = 0.0) -> Tuple[int, float]:
+        """Index into user_ids of the closest sample's owner and its squared Euclidean distance"""
+        q = np.ascontiguousarray(query, dtype=np.float32)
+        index = self.search_index(index_path, valid_after)
+
+        if index is not None:
+            # Quantized distances only rank candidates; the tolerance check uses exact float32 ones
+            _, candidates = index.search(q[None, :], min(RERANK_CANDIDATES, len(self)))
+            candidates = candidates[0][candidates[0] >= 0]
+            sq_distances = self.sq_norms[candidates] - 2.0 * (self.encodings[candidates] @ q) + np.dot(q, q)
+            best = int(np.argmin(sq_distances))
+            row, best_sq_distance = candidates[best], sq_distances[best]
+        elif len(self) > 0 and load_argmin_kernel() is not None:
+            # The compiled scan returns the argmin without materializing all distances
+            row, best_sq_distance = load_argmin_kernel()(self.encodings, q)
+        else:
+            sq_distances = self.sq_distances(q)
+            row = int(np.argmin(sq_distances))
+            best_sq_distance = sq_distances[row]
+
+        return int(self.owners[row]), max(float(best_sq_distance), 0.0)
+
+    def sq_distances(self, query: np.ndarray) -> np.ndarray:
+        """Squared Euclidean distance to every stored sample; no sqrt in the hot path"""
+        q = np.asarray(query, dtype=np.float32)
+
+        # Small galleries: one fused loop beats the BLAS call and its temporaries
+        kernel = load_scan_kernel() if 0 < len(self) <= SCAN_KERNEL_MAX_SAMPLES else None
+        if kernel is not None:
+            sq_distances = np.empty(len(self), dtype=np.float32)
+            kernel(self.encodings, np.ascontiguousarray(q), sq_distances)
+            return sq_distances
+
+        sq_distances = self.sq_norms - 2.0 * (self.encodings @ q) + np.dot(q, q)
+        return np.maximum(sq_distances, 0.0)
+
+    def user_min_sq_distances(self, query: np.ndarray) -> np.ndarray:
+        """Per-user minimum squared Euclidean distance, ordered like user_ids"""
+        return np.minimum.reduceat(self.sq_distances(query), self.offsets[:-1])
+
+    def user_distance_stats(self, query: np.ndarray, metric: str = "euclidean") -> Tuple[np.ndarray, np.ndarray]:
+        """Per-user (min, mean) distance to the query, ordered like user_ids"""
+        kernel = load_score_kernel()
+        if metric == "euclidean" and kernel is not None and len(self.user_ids) > 0:
+            stats = kernel(self.encodings, self.offsets, np.ascontiguousarray(query, dtype=np.float32))
+            return stats[:, 0], stats[:, 1]
+
+        distances = self.distances(query, metric)
+        starts = self.offsets[:-1]
+        mins = np.minimum.reduceat(distances, starts)
+        means = np.add.reduceat(distances, starts) / np.diff(self.offsets)
+        return mins, means
+
+    def user_knn_distances(self, query: np.ndarray, k: int = 3, metric: str = "euclidean") -> np.ndarray:
+        """Per-user mean distance to the k nearest samples (fewer if a user has fewer), ordered like user_ids"""
+        distances = self.distances(query, metric)
+        scores = np.empty(len(self.user_ids), dtype=np.float32)
+        for i, (start, end) in enumerate(zip(self.offsets[:-1], self.offsets[1:])):
+            segment = distances[start:end]
+            nearest = min(k, len(segment))
+            # Partial selection is O(n) per user instead of a full sort
+            scores[i] = np.partition(segment, nearest - 1)[:nearest].mean()
+        return scores
+
+
+def list_source_files(source_dir: str) -> List[str]:
+    """Sorted names of the user files (JSON and encoding sidecars) in source_dir"""
+    return sorted(f for f in os.listdir(source_dir) if f.endswith(SOURCE_FILE_EXTENSIONS))
+
+
+def load_source_cache(source_dir: str, source_files: List[str]) -> Optional[FaceGallery]:
+    """
+    The consolidated cache of source_dir, or None when it must be rebuilt: missing, unreadable,
+    older than a user file, or built from a different file list (a user file was added or removed)
+    """
+    cache_path = os.path.join(source_dir, SOURCE_CACHE_NAME)
+    if not source_files or not os.path.exists(cache_path):
+        return None
+
+    newest_file = max(os.path.getmtime(os.path.join(source_dir, name)) for name in source_files)
+    if os.path.getmtime(cache_path) < newest_file:
+        return None
+
+    try:
+        cached = FaceGallery.load(cache_path)
+    except Exception as e:
+        print(f"Warning: Ignoring unreadable cache {cache_path}: {e}")
+        return None
+    return cached if cached.sources == source_files else None
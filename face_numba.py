@@ -0,0 +1,49 @@
+"""
+Numba kernels for gallery scoring
+Compiled ahead of time into the face_kernels extension by build_kernels.py;
+face_core only uses that build, so Numba is never imported at run time
+"""
+
+import numpy as np
+from numba import prange
+
+
+def score_users(encodings, offsets, query):
+    """
+    Per-user (min, mean) Euclidean distance in one fused pass over the gallery
+    Row u of the result holds the stats for samples offsets[u]:offsets[u+1]
+    """
+    num_users = len(offsets) - 1
+    dim = encodings.shape[1]
+    stats = np.empty((num_users, 2), dtype=np.float32)
+
+    for u in prange(num_users):
+        start = offsets[u]
+        end = offsets[u + 1]
+        min_distance = 1e30
+        total = 0.0
+        for i in range(start, end):
+            sq_distance = 0.0
+            for k in range(dim):
+                diff = encodings[i, k] - query[k]
+                sq_distance += diff * diff
+            distance = np.sqrt(sq_distance)
+            if distance < min_distance:
+                min_distance = distance
+            total += distance
+        stats[u, 0] = min_distance
+        stats[u, 1] = total / (end - start)
+
+    return stats
+
+
+def l2_scan(encodings, query, out):
+    """Squared Euclidean distance from the query to every row, written into out"""
+    dim = encodings.shape[1]
+    for i in prange(encodings.shape[0]):
+        sq_distance = 0.0
+        for k in range(dim):
+            diff = encodings[i, k] - query[k]
+            sq_distance += diff * diff
+        out[i] = sq_distance
+
@@ -0,0 +1,38 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True, language_level=3
+# distutils: extra_compile_args = -O3 -march=native -funroll-loops -fopenmp
+# distutils: extra_link_args = -fopenmp
+"""
+Cython nearest-sample search over the stacked gallery
+Optional: picked up by face_core when built in place with
+    cythonize -i fast_match.pyx
+"""
+
+import numpy as np
+from cython.parallel import prange
+
+
+cpdef tuple argmin_l2(const float[:, ::1] encodings, const float[::1] query):
+    """Return (row, squared Euclidean distance) of the stored sample closest to the query"""
+    cdef Py_ssize_t num_rows = encodings.shape[0]
+    cdef Py_ssize_t dim = encodings.shape[1]
+    cdef float[::1] sq_distances = np.empty(num_rows, dtype=np.float32)
+    cdef Py_ssize_t i, k
+    cdef Py_ssize_t best = 0
+    cdef float total, diff
+
+    if num_rows == 0:
+        return -1, float("inf")
+
+    # Rows are independent, so OpenMP splits them across cores; the short argmin stays serial
+    for i in prange(num_rows, nogil=True, schedule='static'):
+        total = 0
+        for k in range(dim):
+            diff = encodings[i, k] - query[k]
+            total = total + diff * diff
+        sq_distances[i] = total
+
+    for i in range(1, num_rows):
+        if sq_distances[i] < sq_distances[best]:
+            best = i
+
+    return best, sq_distances[best]
@@ -5,20 +5,44 @@ Achieves 99%+ accuracy using industry-standard libraries
 """
 
 import face_recognition
+import dlib
 import cv2
 import numpy as np
 import json
+import math
 import os
+import queue
+import threading
 import time
 from datetime import datetime
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Union
 import pickle
 import argparse
 
+from face_core import (DEFAULT_TOLERANCES, ENCODING_FORMATS, FaceGallery, save_encoding_sidecar, user_entry_encodings,
+                       batch_detect_face_locations, copy_to_buffer, detect_face_locations, open_camera,
+                       preview_available, write_json, auth_log_path, record_authentication, append_auth_log,
+                       replay_auth_log)
+
 class HighAccuracyFaceAuth:
-    def __init__(self, db_path: str = "python_face_database.json"):
+    # Detection runs on a copy shrunk by this factor; encoding still uses the full frame.
+    # Half of the 640x480 capture keeps faces at arm's length above HOG's minimum size.
+    DETECTION_SCALE = 0.5
+
+    def __init__(self, db_path: str = "python_face_database.json", encodings_dir: str = "generated",
+                 encoding_format: str = "npy", save_debug: bool = False, pretty: bool = False):
         self.db_path = db_path
+        self.encodings_dir = encodings_dir
+        self.pretty = pretty
+        self.show_preview = preview_available()
+        self.encoding_format = encoding_format
+        self.save_debug = save_debug
+        self.auth_log_path = auth_log_path(db_path)
+        self.gallery_path = os.path.splitext(db_path)[0] + "_gallery.npz"
+        # Encodings file pointers in the database are relative to its directory
+        self.db_dir = os.path.dirname(os.path.abspath(db_path))
         self.face_encodings_cache = {}
+        self._display_frame = None
         self.load_database()
 
     def load_database(self):
@@ -40,91 +64,228 @@ class HighAccuracyFaceAuth:
             print(f"❌ Error loading database: {e}")
             self.database = {"users": {}, "version": "1.0", "accuracy_threshold": 0.6}
 
+        self.replay_auth_log()
+        self.load_gallery()
+
+    def load_gallery(self):
+        """Load the stacked gallery from its .npz cache, rebuilding it when its sources are newer"""
+        if self.gallery_cache_fresh():
+            try:
+                self.gallery = FaceGallery.load(self.gallery_path)
+                return
+            except Exception as e:
+                print(f"⚠️  Gallery cache unreadable, rebuilding: {e}")
+
+        self.load_encodings_cache()
+
+    def gallery_cache_fresh(self) -> bool:
+        """Whether the .npz cache is at least as new as the database and every file it points at"""
+        if not os.path.exists(self.gallery_path) or not os.path.exists(self.db_path):
+            return False
+
+        cache_mtime = os.path.getmtime(self.gallery_path)
+        sources = [self.db_path] + [os.path.join(self.db_dir, user_data["encodings_file"])
+                                    for user_data in self.database.get("users", {}).values()
+                                    if user_data.get("encodings_file")]
+        return all(os.path.exists(path) and os.path.getmtime(path) <= cache_mtime for path in sources)
+
+    def load_encodings_cache(self):
+        """
+        Load each user's float32 encoding matrix from the file its database record points at,
+        or from encodings embedded in the record (older databases, Simple registrations and imports)
+        """
+        self.face_encodings_cache = {}
+        for user_id, user_data in self.database.get("users", {}).items():
+            try:
+                encodings = user_entry_encodings(user_data, self.db_dir)
+            except Exception as e:
+                print(f"⚠️  Could not load encodings for '{user_id}': {e}")
+                continue
+            if encodings is not None:
+                self.face_encodings_cache[user_id] = encodings
+
+        self.rebuild_gallery()
+
+    def rebuild_gallery(self):
+        """Stack every cached user matrix into one gallery and persist it for the next run"""
+        self.gallery = FaceGallery(list(self.face_encodings_cache.keys()),
+                                   list(self.face_encodings_cache.values()))
+        if os.path.exists(self.db_path):
+            try:
+                self.gallery.save(self.gallery_path)
+            except Exception as e:
+                print(f"⚠️  Could not save gallery cache: {e}")
+
     def save_database(self):
         """Save database to file"""
         try:
-            with open(self.db_path, 'w') as f:
-                json.dump(self.database, f, indent=2)
+            write_json(self.db_path, self.database, indent=self.pretty)
+
+            # Logged authentications are folded into the JSON now
+            if os.path.exists(self.auth_log_path):
+                os.remove(self.auth_log_path)
         except Exception as e:
             print(f"❌ Error saving database: {e}")
 
-    def capture_from_camera(self, save_path: str) -> bool:
-        """Capture image from camera with auto-capture"""
+    def record_authentication(self, user_id: str, when: datetime):
+        """Bump a user's authentication stats in memory"""
+        record_authentication(self.database, user_id, when)
+
+    def append_auth_log(self, user_id: str, when: datetime):
+        """Append one authentication record instead of rewriting the whole database"""
+        try:
+            append_auth_log(self.auth_log_path, user_id, when)
+        except Exception as e:
+            print(f"❌ Error writing authentication log: {e}")
+
+    def replay_auth_log(self):
+        """Apply authentications logged since the last save to the in-memory database"""
+        try:
+            replay_auth_log(self.auth_log_path, self.database)
+        except Exception as e:
+            print(f"❌ Error reading authentication log: {e}")
+
+    def capture_from_camera(self) -> Optional[np.ndarray]:
+        """Capture a BGR frame from camera with auto-capture, or None on failure"""
         print("📷 Initializing camera...")
-        cap = cv2.VideoCapture(0)
+        cap = open_camera()
 
         if not cap.isOpened():
             print("❌ Could not open camera")
-            return False
+            return None
 
         print("📸 Camera ready! Auto-capturing in 3 seconds...")
         print("💡 Look directly at the camera and stay still...")
 
-        # Auto-capture after a short delay
-        frame_count = 0
-        capture_frame = 90  # Capture after ~3 seconds (30 FPS)
+        # Camera reads run on a background thread so GUI work here never stalls them.
+        # The reader drops frames with grab() (no decode) and only decodes one when
+        # the display loop asks for it; imshow stays on the main thread, which
+        # macOS requires for HighGUI windows.
+        frames = queue.Queue(maxsize=1)
+        frame_requested = threading.Event()
+        stop_reading = threading.Event()
+        read_failed = threading.Event()
+
+        def read_frames():
+            while not stop_reading.is_set():
+                if frame_requested.is_set():
+                    ok, frame = cap.read()
+                    if ok:
+                        frame_requested.clear()
+                        frames.put(frame)
+                else:
+                    ok = cap.grab()
+                if not ok:
+                    read_failed.set()
+                    return
+
+        def next_frame() -> Optional[np.ndarray]:
+            frame_requested.set()
+            while not read_failed.is_set():
+                try:
+                    return frames.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return None
+
+        def finish():
+            stop_reading.set()
+            reader.join(timeout=1.0)
+            cap.release()
+            if self.show_preview:
+                cv2.destroyAllWindows()
 
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                print("❌ Failed to read from camera")
-                break
+        reader = threading.Thread(target=read_frames, daemon=True)
+        reader.start()
 
-            frame_count += 1
+        # Auto-capture after a wall-clock countdown, redrawing the overlay every 300 ms
+        capture_delay = 3.0
+        overlay_interval = 0.3
+        start_time = time.monotonic()
+        last_announced = None
 
-            # Show countdown
-            if frame_count % 30 == 0:  # Every second
-                seconds_left = max(0, 3 - (frame_count // 30))
-                if seconds_left > 0:
-                    print(f"📸 Capturing in {seconds_left}...")
+        while True:
+            elapsed = time.monotonic() - start_time
+            if elapsed >= capture_delay:
+                break
 
-            # Display frame with countdown
-            display_frame = frame.copy()
-            if frame_count < capture_frame:
-                seconds_left = max(0, 3 - (frame_count // 30))
-                cv2.putText(display_frame, f"Capturing in {seconds_left}...",
-                           (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-            else:
-                cv2.putText(display_frame, "CAPTURED!",
-                           (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            seconds_left = int(math.ceil(capture_delay - elapsed))
+            if seconds_left != last_announced:
+                print(f"📸 Capturing in {seconds_left}...")
+                last_announced = seconds_left
+
+            if not self.show_preview:
+                # No window: the reader keeps the camera current while this thread just waits
+                if read_failed.is_set():
+                    print("❌ Failed to read from camera")
+                    finish()
+                    return None
+                time.sleep(min(overlay_interval, capture_delay - elapsed))
+                continue
 
-            cv2.imshow('Face Authentication - Auto Capture', display_frame)
+            frame = next_frame()
+            if frame is None:
+                print("❌ Failed to read from camera")
+                finish()
+                return None
 
-            # Auto-capture
-            if frame_count >= capture_frame:
-                cv2.imwrite(save_path, frame)
-                print(f"✅ Image auto-captured: {save_path}")
-                break
+            # Display frame with countdown, drawn in place since it is discarded
+            cv2.putText(frame, f"Capturing in {seconds_left}...",
+                       (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            cv2.imshow('Face Authentication - Auto Capture', frame)
 
-            # Allow manual escape
-            key = cv2.waitKey(1) & 0xFF
+            # Allow manual escape; the wait also paces the redraws
+            remaining_ms = int((capture_delay - (time.monotonic() - start_time)) * 1000)
+            key = cv2.waitKey(max(1, min(int(overlay_interval * 1000), remaining_ms))) & 0xFF
             if key == 27:  # Escape key
                 print("❌ Capture cancelled")
-                cap.release()
-                cv2.destroyAllWindows()
-                return False
-
-        cap.release()
-        cv2.destroyAllWindows()
-        return True
-
-    def detect_and_encode_faces(self, image_path: str) -> Tuple[List[np.ndarray], List[Tuple]]:
+                finish()
+                return None
+
+        # Auto-capture
+        frame = next_frame()
+        if frame is None:
+            print("❌ Failed to read from camera")
+            finish()
+            return None
+
+        print("✅ Image auto-captured")
+
+        if self.show_preview:
+            # The captured frame goes to the encoder, so annotate the reusable display buffer
+            self._display_frame = copy_to_buffer(self._display_frame, frame)
+            cv2.putText(self._display_frame, "CAPTURED!",
+                       (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            cv2.imshow('Face Authentication - Auto Capture', self._display_frame)
+            cv2.waitKey(1)
+
+        finish()
+        return frame
+
+    def detect_and_encode_faces(self, image: Union[str, np.ndarray]) -> Tuple[List[np.ndarray], List[Tuple]]:
         """
         Detect faces and generate high-accuracy encodings
+        Accepts an image path or an already loaded RGB array
         Returns: (face_encodings, face_locations)
         """
-        print(f"🔍 Analyzing image: {image_path}")
+        if isinstance(image, str):
+            print(f"🔍 Analyzing image: {image}")
 
-        # Load image
-        image = face_recognition.load_image_file(image_path)
+            # Load image
+            image = face_recognition.load_image_file(image)
 
         # Find face locations using CNN model (more accurate but slower)
         print("🎯 Detecting faces with CNN model...")
-        face_locations = face_recognition.face_locations(image, model="cnn")
+        face_locations = detect_face_locations(image, model="cnn", scale=self.DETECTION_SCALE)
 
         if not face_locations:
             print("⚠️  No faces found, trying HOG model...")
             # Fallback to HOG model (faster but less accurate)
+            face_locations = detect_face_locations(image, model="hog", scale=self.DETECTION_SCALE)
+
+        if not face_locations and self.DETECTION_SCALE < 1.0:
+            print("⚠️  No faces found, retrying HOG model at full resolution...")
+            # Small or distant faces can vanish in the downscaled copy
             face_locations = face_recognition.face_locations(image, model="hog")
 
         if not face_locations:
@@ -139,13 +300,30 @@ class HighAccuracyFaceAuth:
         print(f"✅ Generated {len(face_encodings)} face encoding(s)")
         return face_encodings, face_locations
 
+    def batch_detect_faces(self, frames: List[np.ndarray]) -> List[List[Tuple]]:
+        """
+        Run CNN detection over all frames in one batched GPU call when dlib is built with CUDA
+        Returns an empty location list per frame when batching is unavailable
+        """
+        if not frames or not dlib.DLIB_USE_CUDA:
+            return [[] for _ in frames]
+
+        print(f"🎯 Detecting faces in {len(frames)} samples with batched CNN model (CUDA)...")
+        batch_locations = batch_detect_face_locations(frames, self.DETECTION_SCALE)
+        if batch_locations is None:
+            # batch_face_locations needs every frame at the same resolution
+            return [[] for _ in frames]
+        return batch_locations
+
     def register_user(self, user_id: str, num_samples: int = 3) -> bool:
         """Register user with multiple face samples"""
         print(f"\n🎯 === Face Registration for User: '{user_id}' ===")
         print(f"📊 Will capture {num_samples} samples for optimal accuracy")
 
         face_encodings = []
+        captured = []
 
+        # Capture every sample first so detection can run as one batch
         for i in range(num_samples):
             print(f"\n--- 📸 Sample {i+1}/{num_samples} ---")
             print("💡 Tips for best results:")
@@ -154,45 +332,74 @@ class HighAccuracyFaceAuth:
             print("   • Keep a neutral expression")
             print("   • Avoid glasses/hats if possible")
 
-            # Capture image
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-            image_path = f"captured_images/registration_{user_id}_{timestamp}_sample{i+1}.jpg"
-
-            os.makedirs("captured_images", exist_ok=True)
+            # Capture image; one clock read per sample feeds the file name, sample id and timestamp
+            captured_at = datetime.now()
+            timestamp = captured_at.strftime("%Y%m%d_%H%M%S_%f")
 
-            if not self.capture_from_camera(image_path):
+            frame = self.capture_from_camera()
+            if frame is None:
                 print(f"❌ Failed to capture sample {i+1}")
                 continue
 
+            # The frame is encoded from memory; writing it out is only for debugging
+            image_path = None
+            if self.save_debug:
+                image_path = f"captured_images/registration_{user_id}_{timestamp}_sample{i+1}.jpg"
+                os.makedirs("captured_images", exist_ok=True)
+                cv2.imwrite(image_path, frame)
+                print(f"✅ Sample saved: {image_path}")
+            else:
+                print(f"✅ Sample {i+1} captured")
+            captured.append((i + 1, timestamp, captured_at.isoformat(), image_path,
+                             cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+
+        frames = [frame for _, _, _, _, frame in captured]
+        batch_locations = self.batch_detect_faces(frames)
+
+        for (sample_number, timestamp, captured_iso, image_path, frame), locations in zip(captured, batch_locations):
             try:
                 # Extract face encodings
-                encodings, locations = self.detect_and_encode_faces(image_path)
+                if locations:
+                    encodings = face_recognition.face_encodings(frame, locations)
+                else:
+                    encodings, locations = self.detect_and_encode_faces(frame)
 
                 if encodings:
                     face_encodings.append({
-                        "encoding": encodings[0].tolist(),  # Convert numpy array to list for JSON
-                        "timestamp": datetime.now().isoformat(),
+                        "encoding": encodings[0],  # Serialized as a list by write_json
+                        "timestamp": captured_iso,
                         "image_path": image_path,
                         "sample_id": f"{user_id}_{timestamp}"
                     })
-                    print(f"✅ Sample {i+1} processed successfully!")
+                    print(f"✅ Sample {sample_number} processed successfully!")
                 else:
-                    print(f"❌ No face found in sample {i+1}")
+                    print(f"❌ No face found in sample {sample_number}")
 
             except Exception as e:
-                print(f"❌ Error processing sample {i+1}: {e}")
+                print(f"❌ Error processing sample {sample_number}: {e}")
 
         if not face_encodings:
             print("❌ No valid face samples captured")
             return False
 
-        # Store in database
+        # Binary sidecar keeps encodings out of the JSON; it is written first so the
+        # database record never points at a missing or older file
+        os.makedirs(self.encodings_dir, exist_ok=True)
+        encodings_base = os.path.join(self.encodings_dir, user_id)
+        save_encoding_sidecar(encodings_base, [sample["encoding"] for sample in face_encodings],
+                              self.encoding_format)
+        encodings_file = os.path.relpath(os.path.abspath(encodings_base + ENCODING_FORMATS[self.encoding_format]),
+                                         self.db_dir)
+
+        # Store in database: metadata plus a pointer to the encodings
         if "users" not in self.database:
             self.database["users"] = {}
 
         self.database["users"][user_id] = {
             "user_id": user_id,
-            "face_encodings": face_encodings,
+            "encodings_file": encodings_file,
+            "samples": [{key: value for key, value in sample.items() if key != "encoding"}
+                        for sample in face_encodings],
             "enrollment_date": datetime.now().isoformat(),
             "sample_count": len(face_encodings),
             "last_authentication": None,
@@ -201,30 +408,39 @@ class HighAccuracyFaceAuth:
 
         self.save_database()
 
+        # The gallery may have come from the .npz cache, so rebuild it from every user
+        self.load_encodings_cache()
+
         print(f"\n🎉 === Registration Complete ===")
         print(f"✅ Successfully registered {len(face_encodings)} samples for '{user_id}'")
         print(f"🔐 User is ready for high-accuracy authentication!")
 
         return True
 
-    def authenticate_user(self, tolerance: float = 0.6) -> Dict:
-        """Authenticate user with high accuracy"""
+    def authenticate_user(self, tolerance: float = 0.6, metric: str = "euclidean", knn: Optional[int] = None) -> Dict:
+        """Authenticate user with high accuracy; knn scores by the mean of each user's k nearest samples"""
         print("\n🔍 === Face Authentication ===")
 
         # Capture authentication image
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        auth_image_path = f"captured_images/authentication_{timestamp}.jpg"
-
-        os.makedirs("captured_images", exist_ok=True)
-
-        if not self.capture_from_camera(auth_image_path):
+        frame = self.capture_from_camera()
+        if frame is None:
             return {"success": False, "error": "Failed to capture image"}
 
+        # The frame stays in memory; writing it out is only for debugging
+        auth_image_path = None
+        if self.save_debug:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            auth_image_path = f"captured_images/authentication_{timestamp}.jpg"
+            os.makedirs("captured_images", exist_ok=True)
+            cv2.imwrite(auth_image_path, frame)
+            print(f"💾 Debug image saved: {auth_image_path}")
+
         start_time = time.time()
 
         try:
             # Extract face encoding from authentication image
-            auth_encodings, auth_locations = self.detect_and_encode_faces(auth_image_path)
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            auth_encodings, auth_locations = self.detect_and_encode_faces(rgb_frame)
 
             if not auth_encodings:
                 return {"success": False, "error": "No face detected in authentication image"}
@@ -237,28 +453,30 @@ class HighAccuracyFaceAuth:
             best_match = None
             best_distance = float('inf')
 
-            for user_id, user_data in self.database.get("users", {}).items():
-                user_encodings = [np.array(sample["encoding"]) for sample in user_data["face_encodings"]]
-
-                # Calculate distances to all samples for this user
-                distances = face_recognition.face_distance(user_encodings, auth_encoding)
-                min_distance = np.min(distances)
-                avg_distance = np.mean(distances)
-
-                # Use weighted score: 70% minimum distance, 30% average distance
-                score = 0.7 * min_distance + 0.3 * avg_distance
+            if len(self.gallery.user_ids) > 0:
+                # Distances to every stored sample in one pass, reduced per user
+                min_distances, avg_distances = self.gallery.user_distance_stats(auth_encoding, metric)
 
-                print(f"👤 User '{user_id}': min_dist={min_distance:.3f}, avg_dist={avg_distance:.3f}, score={score:.3f}")
-
-                if score < best_distance:
-                    best_distance = score
-                    best_match = {
-                        "user_id": user_id,
-                        "distance": min_distance,
-                        "avg_distance": avg_distance,
-                        "confidence": max(0, 1 - min_distance),  # Convert distance to confidence
-                        "score": score
-                    }
+                if knn:
+                    # k-NN vote: mean of the k nearest samples is robust to one lucky match
+                    scores = self.gallery.user_knn_distances(auth_encoding, knn, metric)
+                else:
+                    # Use weighted score: 70% minimum distance, 30% average distance
+                    scores = 0.7 * min_distances + 0.3 * avg_distances
+
+                for user_id, min_distance, avg_distance, score in zip(
+                        self.gallery.user_ids, min_distances, avg_distances, scores):
+                    print(f"👤 User '{user_id}': min_dist={min_distance:.3f}, avg_dist={avg_distance:.3f}, score={score:.3f}")
+
+                best_index = int(np.argmin(scores))
+                best_distance = float(scores[best_index])
+                best_match = {
+                    "user_id": self.gallery.user_ids[best_index],
+                    "distance": float(min_distances[best_index]),
+                    "avg_distance": float(avg_distances[best_index]),
+                    "confidence": max(0, 1 - float(min_distances[best_index])),  # Convert distance to confidence
+                    "score": best_distance
+                }
 
             processing_time = time.time() - start_time
 
@@ -277,11 +495,10 @@ class HighAccuracyFaceAuth:
             }
 
             if is_match:
-                # Update authentication stats
-                user_data = self.database["users"][best_match["user_id"]]
-                user_data["last_authentication"] = datetime.now().isoformat()
-                user_data["authentication_count"] = user_data.get("authentication_count", 0) + 1
-                self.save_database()
+                # Update authentication stats; the JSON is rewritten on the next save or --flush
+                now = datetime.now()
+                self.record_authentication(best_match["user_id"], now)
+                self.append_auth_log(best_match["user_id"], now)
 
                 print(f"\n✅ Authentication Successful!")
                 print(f"👤 User: {best_match['user_id']}")
@@ -307,12 +524,28 @@ def main():
                        help="Mode: register or authenticate")
     parser.add_argument("--user", type=str, help="User ID for registration")
     parser.add_argument("--samples", type=int, default=3, help="Number of samples for registration")
-    parser.add_argument("--tolerance", type=float, default=0.6, help="Authentication tolerance")
+    parser.add_argument("--tolerance", type=float, default=None,
+                       help="Authentication tolerance (default: 0.6 euclidean, 0.18 cosine)")
+    parser.add_argument("--metric", choices=list(DEFAULT_TOLERANCES), default="euclidean",
+                       help="Distance metric used for matching")
+    parser.add_argument("--knn", type=int, default=None,
+                       help="Score each user by the mean distance of their k nearest samples")
+    parser.add_argument("--encoding-format", choices=list(ENCODING_FORMATS), default="npy",
+                       help="Sidecar format for registered encodings: float32 .npy or packed float16/int8 .bin")
+    parser.add_argument("--save-debug", action="store_true",
+                       help="Also write captured frames to captured_images/")
+    parser.add_argument("--pretty", action="store_true",
+                       help="Indent the database JSON (default: compact)")
+    parser.add_argument("--flush", action="store_true",
+                       help="Fold the authentication log into the database JSON")
 
     args = parser.parse_args()
+    if args.tolerance is None:
+        args.tolerance = DEFAULT_TOLERANCES[args.metric]
 
     # Initialize face authentication system
-    face_auth = HighAccuracyFaceAuth()
+    face_auth = HighAccuracyFaceAuth(encoding_format=args.encoding_format, save_debug=args.save_debug,
+                                     pretty=args.pretty)
 
     if args.mode == "register":
         if not args.user:
@@ -326,7 +559,10 @@ def main():
             print("❌ Registration failed!")
 
     elif args.mode == "auth":
-        result = face_auth.authenticate_user(args.tolerance)
+        result = face_auth.authenticate_user(args.tolerance, args.metric, args.knn)
+
+        if args.flush:
+            face_auth.save_database()
 
         if result["success"] and result["is_match"]:
             print("🎉 Access Granted!")
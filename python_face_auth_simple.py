@@ -4,30 +4,62 @@ Simplified Python Face Authentication for integration with Rust
 Auto-captures without manual interaction
 """
 
-import face_recognition
-import cv2
 import numpy as np
 import json
+import math
 import os
 import time
 import sys
+import multiprocessing
 from datetime import datetime
-from typing import List, Dict, Tuple, Optional
+from typing import TYPE_CHECKING, List, Dict, Tuple, Optional, Union
 import argparse
 
+if TYPE_CHECKING:
+    import cv2
+
+from face_core import (DEFAULT_TOLERANCES, ENCODING_FORMATS, FAISS_MIN_SAMPLES, SOURCE_CACHE_NAME, SOURCE_INDEX_NAME,
+                       FaceGallery, list_source_files, load_source_cache, load_argmin_kernel,
+                       save_encoding_sidecar, load_user_files, user_entry_encodings, batch_detect_face_locations,
+                       batch_face_encodings, copy_to_buffer, detect_face_locations, encode_face, open_camera,
+                       preview_available, write_json, auth_log_path, replay_auth_log)
+
 class SimpleFaceAuth:
-    def __init__(self, db_path: str = "python_face_database.json"):
+    # Frames grabbed when the camera is opened, and seconds between countdown preview redraws
+    WARMUP_GRABS = 3
+    PREVIEW_INTERVAL = 0.3
+
+    # HOG detection runs on frames shrunk by this factor; half of the 640x480 capture keeps
+    # faces at arm's length above HOG's minimum size
+    DETECTION_SCALE = 0.5
+
+    def __init__(self, db_path: str = "python_face_database.json", encoding_format: str = "npy",
+                 save_debug: bool = False, pretty: bool = False):
         self.db_path = db_path
-        self.load_database()
+        self.auth_log_path = auth_log_path(db_path)
+        self.encoding_format = encoding_format
+        self.save_debug = save_debug
+        self.pretty = pretty
+        self.show_preview = preview_available()
+        self._cap = None
+        self._display_frame = None
+        self._database = None
+
+    @property
+    def database(self) -> Dict:
+        """The face database, loaded on first use; authentication matches against source/ and never reads it"""
+        if self._database is None:
+            self.load_database()
+        return self._database
 
     def load_database(self):
         """Load face database or create new one"""
         try:
             if os.path.exists(self.db_path):
                 with open(self.db_path, 'r') as f:
-                    self.database = json.load(f)
+                    self._database = json.load(f)
             else:
-                self.database = {
+                self._database = {
                     "users": {},
                     "version": "1.0",
                     "accuracy_threshold": 0.6,
@@ -35,132 +67,227 @@ class SimpleFaceAuth:
                 }
         except Exception as e:
             print(f"Error loading database: {e}")
-            self.database = {"users": {}, "version": "1.0", "accuracy_threshold": 0.6}
+            self._database = {"users": {}, "version": "1.0", "accuracy_threshold": 0.6}
+
+        # The high-accuracy script logs authentications instead of rewriting the JSON
+        try:
+            replay_auth_log(self.auth_log_path, self._database)
+        except Exception as e:
+            print(f"Error reading authentication log: {e}")
 
     def save_database(self):
         """Save database to file"""
         try:
-            with open(self.db_path, 'w') as f:
-                json.dump(self.database, f, indent=2)
+            write_json(self.db_path, self.database, indent=self.pretty)
+
+            # Logged authentications are folded into the JSON now
+            if os.path.exists(self.auth_log_path):
+                os.remove(self.auth_log_path)
         except Exception as e:
             print(f"Error saving database: {e}")
 
-    def auto_capture_image(self, save_path: str, delay_seconds: int = 2) -> bool:
-        """Auto-capture image from camera after delay"""
-        print(f"Initializing camera for auto-capture...")
+    def auto_capture_frame(self, delay_seconds: int = 2) -> Optional[np.ndarray]:
+        """Auto-capture a BGR frame from camera after delay, or None on failure"""
+        import cv2
 
-        cap = cv2.VideoCapture(0)
-        if not cap.isOpened():
-            print("Error: Could not open camera")
-            return False
+        cap = self.get_camera()
+        if cap is None:
+            return None
 
         print(f"Camera ready! Auto-capturing in {delay_seconds} seconds...")
         print("Look directly at the camera and stay still...")
 
-        # Wait for camera to stabilize
-        for i in range(30):
-            ret, frame = cap.read()
-            if not ret:
+        # Countdown: grab() keeps the buffer current without decoding; only the periodic
+        # preview frame is decoded with retrieve()
+        deadline = time.monotonic() + delay_seconds
+        next_preview = 0.0
+        last_announced = None
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+
+            seconds_left = int(math.ceil(deadline - now))
+            if seconds_left != last_announced:
+                print(f"Capturing in {seconds_left}...")
+                last_announced = seconds_left
+
+            if not cap.grab():
                 print("Error: Failed to read from camera")
-                cap.release()
-                return False
+                self.release_camera()
+                if self.show_preview:
+                    cv2.destroyAllWindows()
+                return None
 
-        # Countdown
-        for i in range(delay_seconds, 0, -1):
-            print(f"Capturing in {i}...")
-            for j in range(30):  # ~1 second at 30 FPS
-                ret, frame = cap.read()
+            # Headless runs keep grabbing so the final frame is current, but never decode a preview
+            if self.show_preview and now >= next_preview:
+                ret, frame = cap.retrieve()
                 if ret:
-                    # Show frame with countdown (optional)
-                    display_frame = frame.copy()
-                    cv2.putText(display_frame, f"Capturing in {i}...",
+                    # Show frame with countdown; drawn in place since countdown frames are discarded
+                    cv2.putText(frame, f"Capturing in {seconds_left}...",
                                (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                    cv2.imshow('Auto Capture', display_frame)
+                    cv2.imshow('Auto Capture', frame)
                     cv2.waitKey(1)
+                next_preview = now + self.PREVIEW_INTERVAL
 
         # Capture the image
         ret, frame = cap.read()
         if ret:
-            cv2.imwrite(save_path, frame)
-            print(f"Image captured: {save_path}")
-
-            # Show captured image briefly
-            cv2.putText(frame, "CAPTURED!", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-            cv2.imshow('Auto Capture', frame)
-            cv2.waitKey(1000)  # Show for 1 second
-
-            cap.release()
-            cv2.destroyAllWindows()
-            return True
+            if self.show_preview:
+                # Show captured image briefly; the frame gets encoded, so annotate the reusable display buffer
+                self._display_frame = copy_to_buffer(self._display_frame, frame)
+                cv2.putText(self._display_frame, "CAPTURED!", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.imshow('Auto Capture', self._display_frame)
+                cv2.waitKey(1000)  # Show for 1 second
+
+                cv2.destroyAllWindows()
+            return frame
         else:
             print("Error: Failed to capture image")
-            cap.release()
-            cv2.destroyAllWindows()
-            return False
+            self.release_camera()
+            if self.show_preview:
+                cv2.destroyAllWindows()
+            return None
 
-    def detect_and_encode_face(self, image_path: str) -> Optional[np.ndarray]:
-        """Detect and encode a single face"""
-        try:
-            # Load image
-            image = face_recognition.load_image_file(image_path)
+    def get_camera(self) -> Optional["cv2.VideoCapture"]:
+        """Open the camera once per process; only the first use pays the stabilization warmup"""
+        if self._cap is not None:
+            return self._cap
 
-            # Find face locations
-            face_locations = face_recognition.face_locations(image, model="hog")
+        print(f"Initializing camera for auto-capture...")
+
+        cap = open_camera()
+        if not cap.isOpened():
+            print("Error: Could not open camera")
+            return None
 
-            if not face_locations:
-                print("No face detected in image")
+        # Confirm frames are flowing; exposure settles during the capture countdown,
+        # which keeps grabbing, so no decoded warmup frames are needed
+        for i in range(self.WARMUP_GRABS):
+            if not cap.grab():
+                print("Error: Failed to read from camera")
+                cap.release()
                 return None
 
-            if len(face_locations) > 1:
-                print(f"Multiple faces detected ({len(face_locations)}), using the first one")
+        self._cap = cap
+        return cap
 
-            # Generate face encoding
-            face_encodings = face_recognition.face_encodings(image, face_locations)
+    def release_camera(self):
+        """Release the shared camera, if open"""
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
 
-            if face_encodings:
-                print(f"Face encoding generated successfully")
-                return face_encodings[0]
-            else:
-                print("Failed to generate face encoding")
+    def __del__(self):
+        try:
+            self.release_camera()
+        except Exception:
+            pass
+
+    def detect_face(self, image: Union[str, np.ndarray]) -> Tuple[np.ndarray, Optional[Tuple]]:
+        """Locate the first face in an image path or RGB array; returns (image, location or None)"""
+        import face_recognition
+
+        # Load image
+        if isinstance(image, str):
+            image = face_recognition.load_image_file(image)
+
+        # Find face locations on a downscaled copy; encoding still uses the full-resolution image
+        face_locations = detect_face_locations(image, model="hog", scale=self.DETECTION_SCALE)
+        if not face_locations and self.DETECTION_SCALE < 1.0:
+            # Faces too small to survive the downscale
+            face_locations = face_recognition.face_locations(image, model="hog")
+
+        if not face_locations:
+            print("No face detected in image")
+            return image, None
+
+        if len(face_locations) > 1:
+            print(f"Multiple faces detected ({len(face_locations)}), using the first one")
+
+        return image, face_locations[0]
+
+    def detect_and_encode_face(self, image: Union[str, np.ndarray]) -> Optional[np.ndarray]:
+        """Detect and encode a single face from an image path or an RGB array"""
+        try:
+            image, face_location = self.detect_face(image)
+            if face_location is None:
                 return None
 
+            # Generate face encoding with the process-wide dlib models
+            face_encoding = encode_face(image, face_location)
+            print(f"Face encoding generated successfully")
+            return face_encoding
+
         except Exception as e:
             print(f"Error processing image: {e}")
             return None
 
     def register_user(self, user_id: str, num_samples: int = 3, generated_dir: str = "generated") -> bool:
         """Register user with multiple face samples and save to specified generated directory"""
+        import cv2
+
         print(f"Starting registration for user: {user_id}")
         print(f"Will capture {num_samples} samples")
         print(f"Generated directory: {generated_dir}")
 
-        os.makedirs("captured_images", exist_ok=True)
         os.makedirs(generated_dir, exist_ok=True)
         face_encodings = []
+        captured = []
 
+        # Frames stay in memory; JPEGs are only written with --save-debug
         for i in range(num_samples):
             print(f"\n--- Sample {i+1}/{num_samples} ---")
 
-            # Capture image
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-            image_path = f"captured_images/registration_{user_id}_{timestamp}_sample{i+1}.jpg"
-
-            if not self.auto_capture_image(image_path, delay_seconds=2):
+            # Capture image; one clock read per sample feeds the file name, sample id and timestamp
+            captured_at = datetime.now()
+            timestamp = captured_at.strftime("%Y%m%d_%H%M%S_%f")
+            frame = self.auto_capture_frame(delay_seconds=2)
+            if frame is None:
                 print(f"Failed to capture sample {i+1}")
                 continue
 
-            # Process image
-            encoding = self.detect_and_encode_face(image_path)
-            if encoding is not None:
-                face_encodings.append({
-                    "encoding": encoding.tolist(),
-                    "timestamp": datetime.now().isoformat(),
-                    "image_path": image_path,
-                    "sample_id": f"{user_id}_{timestamp}"
-                })
-                print(f"Sample {i+1} processed successfully")
+            image_path = None
+            if self.save_debug:
+                image_path = f"captured_images/registration_{user_id}_{timestamp}_sample{i+1}.jpg"
+                os.makedirs("captured_images", exist_ok=True)
+                cv2.imwrite(image_path, frame)
+                print(f"Image captured: {image_path}")
+
+            captured.append((i + 1, timestamp, captured_at.isoformat(), image_path,
+                             cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+
+        # One batched CNN detection pass on CUDA builds; otherwise HOG per sample
+        batch_locations = batch_detect_face_locations([sample[4] for sample in captured], self.DETECTION_SCALE)
+
+        located = []
+        for index, (sample_number, timestamp, captured_iso, image_path, image) in enumerate(captured):
+            if batch_locations and batch_locations[index]:
+                face_location = batch_locations[index][0]
             else:
-                print(f"Failed to process sample {i+1}")
+                try:
+                    image, face_location = self.detect_face(image)
+                except Exception as e:
+                    print(f"Error processing image: {e}")
+                    face_location = None
+
+            if face_location is None:
+                print(f"Failed to process sample {sample_number}")
+                continue
+
+            located.append((sample_number, timestamp, captured_iso, image_path, image, face_location))
+
+        # One batched dlib descriptor call for every located face
+        encodings = batch_face_encodings([sample[4] for sample in located], [sample[5] for sample in located])
+
+        for (sample_number, timestamp, captured_iso, image_path, _, _), encoding in zip(located, encodings):
+            face_encodings.append({
+                "encoding": encoding,  # Serialized as a list by write_json
+                "timestamp": captured_iso,
+                "image_path": image_path,
+                "sample_id": f"{user_id}_{timestamp}"
+            })
+            print(f"Sample {sample_number} processed successfully")
 
         if not face_encodings:
             print("No valid face samples captured")
@@ -170,27 +297,35 @@ class SimpleFaceAuth:
         if "users" not in self.database:
             self.database["users"] = {}
 
+        enrollment_date = datetime.now().isoformat()
         self.database["users"][user_id] = {
             "user_id": user_id,
             "face_encodings": face_encodings,
-            "enrollment_date": datetime.now().isoformat(),
+            "enrollment_date": enrollment_date,
             "sample_count": len(face_encodings)
         }
 
         self.save_database()
 
-        # Save user's face encodings to specified generated directory
+        # Save user's face encodings to specified generated directory: the encodings go to
+        # a binary sidecar and the JSON keeps only metadata plus a pointer to it
         generated_file = os.path.join(generated_dir, f"{user_id}.json")
+        encodings_file = f"{user_id}{ENCODING_FORMATS[self.encoding_format]}"
         user_data = {
             "user_id": user_id,
-            "face_encodings": face_encodings,
-            "enrollment_date": datetime.now().isoformat(),
+            "encodings_file": encodings_file,
+            "samples": [{key: value for key, value in sample.items() if key != "encoding"}
+                        for sample in face_encodings],
+            "enrollment_date": enrollment_date,
             "sample_count": len(face_encodings)
         }
 
         try:
-            with open(generated_file, 'w') as f:
-                json.dump(user_data, f, indent=2)
+            save_encoding_sidecar(os.path.join(generated_dir, user_id),
+                                  [sample["encoding"] for sample in face_encodings], self.encoding_format)
+            print(f"✅ Encodings saved to: {os.path.join(generated_dir, encodings_file)}")
+
+            write_json(generated_file, user_data, indent=self.pretty)
             print(f"✅ User data saved to: {generated_file}")
         except Exception as e:
             print(f"⚠️ Warning: Failed to save to {generated_dir}/ directory: {e}")
@@ -198,23 +333,30 @@ class SimpleFaceAuth:
         print(f"Registration complete! {len(face_encodings)} samples stored for {user_id}")
         return True
 
-    def authenticate_user(self, tolerance: float = 0.6, source_dir: str = "source") -> bool:
+    def authenticate_user(self, tolerance: float = 0.6, source_dir: str = "source", metric: str = "euclidean",
+                          workers: Optional[int] = None) -> bool:
         """Authenticate user by matching against files in specified source directory"""
+        import cv2
+
         print("Starting authentication...")
         print(f"Source directory: {source_dir}")
 
         # Capture authentication image
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        auth_image_path = f"captured_images/authentication_{timestamp}.jpg"
-
-        os.makedirs("captured_images", exist_ok=True)
-
-        if not self.auto_capture_image(auth_image_path, delay_seconds=2):
+        frame = self.auto_capture_frame(delay_seconds=2)
+        if frame is None:
             print("Failed to capture authentication image")
             return False
 
+        # The frame stays in memory; writing it out is only for debugging
+        if self.save_debug:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            auth_image_path = f"captured_images/authentication_{timestamp}.jpg"
+            os.makedirs("captured_images", exist_ok=True)
+            cv2.imwrite(auth_image_path, frame)
+            print(f"Debug image saved: {auth_image_path}")
+
         # Process authentication image
-        auth_encoding = self.detect_and_encode_face(auth_image_path)
+        auth_encoding = self.detect_and_encode_face(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
         if auth_encoding is None:
             print("No face detected in authentication image")
             return False
@@ -226,7 +368,8 @@ class SimpleFaceAuth:
             return False
 
         # Get all JSON files from source/ directory
-        json_files = [f for f in os.listdir(source_dir) if f.endswith('.json')]
+        # Sorted so the cache's row order only depends on which files exist
+        json_files = sorted(f for f in os.listdir(source_dir) if f.endswith('.json'))
 
         if not json_files:
             print(f"No user files found in '{source_dir}' directory")
@@ -236,47 +379,54 @@ class SimpleFaceAuth:
         print(f"Found {len(json_files)} user file(s) in '{source_dir}' directory")
         print(f"Comparing against users from source/ directory...")
 
-        best_match = None
-        best_distance = float('inf')
-        users_loaded = 0
-
-        for json_file in json_files:
-            file_path = os.path.join(source_dir, json_file)
-            try:
-                with open(file_path, 'r') as f:
-                    user_data = json.load(f)
-
-                user_id = user_data.get("user_id")
-                if not user_id:
-                    print(f"Warning: No user_id in {json_file}, skipping")
-                    continue
-
-                face_encodings_data = user_data.get("face_encodings", [])
-                if not face_encodings_data:
-                    print(f"Warning: No face encodings in {json_file}, skipping")
-                    continue
+        # Everything in source/ is consolidated into one cache file, rebuilt whenever a user file
+        # is added, changed or removed
+        source_files = list_source_files(source_dir)
 
-                users_loaded += 1
-                user_encodings = [np.array(sample["encoding"]) for sample in face_encodings_data]
-                distances = face_recognition.face_distance(user_encodings, auth_encoding)
-                min_distance = np.min(distances)
+        # A trained index saved beside the user files numbers the cache's rows, so it is only
+        # reused if written after the cache it indexes; a rebuilt cache always retrains it
+        gallery = load_source_cache(source_dir, source_files)
+        if gallery is not None:
+            index_valid_after = os.path.getmtime(os.path.join(source_dir, SOURCE_CACHE_NAME))
+        else:
+            gallery = self._rebuild_cache(source_dir, json_files, source_files, workers)
+            if gallery is None:
+                return False
+            index_valid_after = math.inf
+
+        # One matrix-vector product against every stored sample, then a per-user min
+        index_path = os.path.join(source_dir, SOURCE_INDEX_NAME)
+        large_gallery = metric == "euclidean" and len(gallery) >= FAISS_MIN_SAMPLES
+        if large_gallery and (gallery.search_index(index_path, index_valid_after) is not None
+                              or load_argmin_kernel() is not None):
+            # Large galleries: a single nearest-sample search (FAISS index, else the compiled
+            # argmin scan), no per-user listing
+            print(f"Searching {len(gallery)} stored samples...")
+            best_index, best_sq_distance = gallery.nearest(auth_encoding)
+            user_scores = np.full(len(gallery.user_ids), np.inf, dtype=np.float32)
+            user_scores[best_index] = best_sq_distance
+            threshold = tolerance * tolerance
+            min_distances = np.sqrt(user_scores)
+        elif metric == "euclidean":
+            # Squared distances are compared against tolerance²; sqrt only feeds the printed values
+            user_scores = gallery.user_min_sq_distances(auth_encoding)
+            threshold = tolerance * tolerance
+            min_distances = np.sqrt(user_scores)
+        else:
+            user_scores, _ = gallery.user_distance_stats(auth_encoding, metric)
+            threshold = tolerance
+            min_distances = user_scores
 
+        for user_id, min_distance in zip(gallery.user_ids, min_distances):
+            if np.isfinite(min_distance):
                 print(f"User {user_id}: distance = {min_distance:.3f}")
 
-                if min_distance < best_distance:
-                    best_distance = min_distance
-                    best_match = user_id
-
-            except Exception as e:
-                print(f"Error loading {json_file}: {e}")
-                continue
-
-        if users_loaded == 0:
-            print("No valid user files could be loaded from source/ directory")
-            return False
+        best_index = int(np.argmin(user_scores))
+        best_match = gallery.user_ids[best_index]
+        best_distance = float(min_distances[best_index])
 
         # Check if match is within tolerance
-        if best_match and best_distance <= tolerance:
+        if best_match and user_scores[best_index] <= threshold:
             confidence = max(0, 1 - best_distance)
             print(f"Authentication successful!")
             print(f"User: {best_match}")
@@ -290,31 +440,83 @@ class SimpleFaceAuth:
                 print(f"Threshold: {tolerance:.3f}")
             return False
 
+    def _rebuild_cache(self, source_dir: str, json_files: List[str], source_files: List[str],
+                       workers: Optional[int] = None) -> Optional[FaceGallery]:
+        """Load every user file in source_dir into a gallery and save it as the consolidated cache"""
+        user_ids = []
+        user_matrices = []
+
+        file_paths = [os.path.join(source_dir, json_file) for json_file in json_files]
+        results = load_user_files(file_paths, workers)
+
+        for json_file, (user_id, user_encodings, error) in zip(json_files, results):
+            if error:
+                print(f"Error loading {json_file}: {error}")
+                continue
+
+            if not user_id:
+                print(f"Warning: No user_id in {json_file}, skipping")
+                continue
+
+            if user_encodings is None or len(user_encodings) == 0:
+                print(f"Warning: No face encodings in {json_file}, skipping")
+                continue
+
+            user_ids.append(user_id)
+            user_matrices.append(user_encodings)
+
+        if not user_ids:
+            print("No valid user files could be loaded from source/ directory")
+            return None
+
+        gallery = FaceGallery(user_ids, user_matrices)
+        try:
+            gallery.save(os.path.join(source_dir, SOURCE_CACHE_NAME), sources=source_files)
+        except Exception as e:
+            print(f"Warning: Failed to write cache to {source_dir}/: {e}")
+        return gallery
+
     def export_user(self, user_id: str, export_path: str = None) -> bool:
         """Export a user's face data to a file"""
         if user_id not in self.database["users"]:
             print(f"User '{user_id}' not found in database")
             return False
 
+        exported_at = datetime.now()
+
         # Auto-generate filename if not provided
         if export_path is None:
             # Create exports directory if it doesn't exist
             export_dir = "exported_credentials"
             os.makedirs(export_dir, exist_ok=True)
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            timestamp = exported_at.strftime("%Y%m%d_%H%M%S")
             export_path = f"{export_dir}/{user_id}_credentials_{timestamp}.json"
 
+        entry = dict(self.database["users"][user_id])
+        if entry.get("encodings_file"):
+            # Records from the high-accuracy script point at an encodings file; exports embed them
+            try:
+                # A plain array: serializers reject the memory-mapped view the loader returns
+                encodings = np.asarray(user_entry_encodings(entry, os.path.dirname(os.path.abspath(self.db_path))))
+            except Exception as e:
+                print(f"Error exporting user: {e}")
+                return False
+            samples = entry.pop("samples", [])
+            del entry["encodings_file"]
+            entry["face_encodings"] = [dict(samples[i] if i < len(samples) else {}, encoding=encoding)
+                                       for i, encoding in enumerate(encodings)]
+            entry["sample_count"] = len(encodings)
+
         user_data = {
             "user_id": user_id,
-            "user_data": self.database["users"][user_id],
-            "exported_at": datetime.now().isoformat(),
+            "user_data": entry,
+            "exported_at": exported_at.isoformat(),
             "version": self.database.get("version", "1.0")
         }
 
         try:
-            with open(export_path, 'w') as f:
-                json.dump(user_data, f, indent=2)
+            write_json(export_path, user_data, indent=self.pretty)
             print(f"User '{user_id}' exported successfully to {export_path}")
             return True
         except Exception as e:
@@ -356,7 +558,7 @@ class SimpleFaceAuth:
 
         print(f"Users in database ({len(self.database['users'])} total):")
         for user_id, user_data in self.database["users"].items():
-            num_encodings = len(user_data.get("face_encodings", []))
+            num_encodings = user_data.get("sample_count", len(user_data.get("face_encodings", [])))
             created = user_data.get("created_at", "Unknown")
             print(f"  - {user_id}: {num_encodings} face samples (created: {created})")
 
@@ -365,20 +567,34 @@ def main():
     parser.add_argument("--mode", choices=["register", "auth", "export", "import", "list"], required=True)
     parser.add_argument("--user", type=str, default="user")
     parser.add_argument("--samples", type=int, default=3)
-    parser.add_argument("--tolerance", type=float, default=0.6)
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="Match tolerance (default: 0.6 euclidean, 0.18 cosine)")
+    parser.add_argument("--metric", choices=list(DEFAULT_TOLERANCES), default="euclidean",
+                        help="Distance metric used for matching")
     parser.add_argument("--file", type=str, help="File path for export/import operations")
     parser.add_argument("--generated-dir", type=str, default="generated", help="Directory to save registered user files")
     parser.add_argument("--source-dir", type=str, default="source", help="Directory to load user files for authentication")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes used to load large source directories (default: all cores)")
+    parser.add_argument("--encoding-format", choices=list(ENCODING_FORMATS), default="npy",
+                        help="Sidecar format for registered encodings: float32 .npy or packed float16/int8 .bin")
+    parser.add_argument("--save-debug", action="store_true",
+                        help="Also write captured frames to captured_images/")
+    parser.add_argument("--pretty", action="store_true",
+                        help="Indent written JSON files (default: compact)")
 
     args = parser.parse_args()
+    if args.tolerance is None:
+        args.tolerance = DEFAULT_TOLERANCES[args.metric]
 
-    face_auth = SimpleFaceAuth()
+    face_auth = SimpleFaceAuth(encoding_format=args.encoding_format, save_debug=args.save_debug,
+                               pretty=args.pretty)
 
     if args.mode == "register":
         success = face_auth.register_user(args.user, args.samples, args.generated_dir)
         sys.exit(0 if success else 1)
     elif args.mode == "auth":
-        success = face_auth.authenticate_user(args.tolerance, args.source_dir)
+        success = face_auth.authenticate_user(args.tolerance, args.source_dir, args.metric, args.workers)
         sys.exit(0 if success else 1)
     elif args.mode == "export":
         success = face_auth.export_user(args.user, args.file)
@@ -394,4 +610,6 @@ def main():
         sys.exit(0)
 
 if __name__ == "__main__":
+    # Required for the user-file process pool inside PyInstaller builds
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -4,24 +4,31 @@ Test script to verify the registration and authentication flow
 Creates mock face encoding data to test the system without camera
 """
 
+import argparse
 import json
 import os
 import numpy as np
 from datetime import datetime
 
-def create_mock_face_encoding():
-    """Create a random 128-dimensional face encoding (standard for face_recognition library)"""
-    return np.random.rand(128).tolist()
+from face_core import write_json
+
+rng = np.random.default_rng()
+
+def create_mock_face_encodings(num_samples):
+    """Create random 128-dimensional face encodings (standard for face_recognition library), one per row"""
+    return rng.random((num_samples, 128), dtype=np.float32)
 
 def create_mock_user(user_id, num_samples=3):
     """Create a mock user with face encodings"""
     face_encodings = []
+    encodings = create_mock_face_encodings(num_samples)
 
     for i in range(num_samples):
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        now = datetime.now()
+        timestamp = now.strftime("%Y%m%d_%H%M%S_%f")
         face_encodings.append({
-            "encoding": create_mock_face_encoding(),
-            "timestamp": datetime.now().isoformat(),
+            "encoding": encodings[i],  # Serialized as a list by write_json
+            "timestamp": now.isoformat(),
             "image_path": f"captured_images/registration_{user_id}_{timestamp}_sample{i+1}.jpg",
             "sample_id": f"{user_id}_{timestamp}"
         })
@@ -35,7 +42,7 @@ def create_mock_user(user_id, num_samples=3):
 
     return user_data
 
-def test_registration():
+def test_registration(pretty=False):
     """Test registration by creating mock user files"""
     print("=" * 60)
     print("Testing Registration Flow")
@@ -53,8 +60,7 @@ def test_registration():
 
         # Save to generated directory
         generated_file = f"generated/{user}.json"
-        with open(generated_file, 'w') as f:
-            json.dump(user_data, f, indent=2)
+        write_json(generated_file, user_data, indent=pretty)
 
         print(f"✅ Created mock user: {user}")
         print(f"   File: {generated_file}")
@@ -68,7 +74,7 @@ def test_registration():
 
     return test_users
 
-def test_source_preparation(users):
+def test_source_preparation(users, pretty=False):
     """Test copying users to source directory"""
     print("\n" + "=" * 60)
     print("Testing Source Directory Preparation")
@@ -85,8 +91,7 @@ def test_source_preparation(users):
         with open(src_file, 'r') as f:
             data = json.load(f)
 
-        with open(dst_file, 'w') as f:
-            json.dump(data, f, indent=2)
+        write_json(dst_file, data, indent=pretty)
 
         print(f"✅ Copied {user} to source/")
 
@@ -136,6 +141,10 @@ def verify_file_structure():
     print("\n✅ All files verified successfully")
 
 def main():
+    parser = argparse.ArgumentParser(description="Create mock face data in generated/ and source/")
+    parser.add_argument("--pretty", action="store_true", help="Indent the JSON files (default: compact)")
+    args = parser.parse_args()
+
     print("\n" + "=" * 60)
     print("FACE AUTHENTICATION SYSTEM - MOCK DATA TEST")
     print("=" * 60)
@@ -143,10 +152,10 @@ def main():
     print("without requiring camera access.\n")
 
     # Test registration (create mock users)
-    users = test_registration()
+    users = test_registration(args.pretty)
 
     # Test source preparation (copy users to source/)
-    source_users = test_source_preparation(users)
+    source_users = test_source_preparation(users, args.pretty)
 
     # Verify file structure
     verify_file_structure()
@@ -174,7 +183,7 @@ def main():
     print("\n4. To test with real users:")
     print("   - Delete mock data: rm -rf generated/* source/*")
     print("   - Run: ./face_auth_env/bin/python python_face_auth_simple.py --mode register --user YOUR_NAME --samples 3")
-    print("   - Copy to source: cp generated/YOUR_NAME.json source/")
+    print("   - Copy to source: cp generated/YOUR_NAME.* source/")
     print("   - Test auth: ./face_auth_env/bin/python python_face_auth_simple.py --mode auth")
     print("\n5. Or use the Rust application:")
     print("   - cargo run")